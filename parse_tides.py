@@ -2,26 +2,97 @@
 and creates JSON files to be consumed by the app
 """
 import argparse
+import concurrent.futures
+import contextlib
 import datetime
+import hashlib
+import ijson
+import itertools
 import requests
-import json
 import os
-import pdfplumber
-from io import BytesIO
+import time
+from operator import itemgetter
+import fitz
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+
+    def loads_json(data):
+        return orjson.loads(data)
+
+    def dumps_json(obj):
+        return orjson.dumps(obj)
+except ImportError:
+    import json
+
+    def loads_json(data):
+        return json.loads(data)
+
+    def dumps_json(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode("utf-8")
+
+REQUEST_TIMEOUT = (5, 30)
+MAX_WORKERS = 16
+CACHE_DIR = "cache"
+CACHE_MAX_AGE_SECONDS = 24 * 60 * 60
+VALIDATORS_FILE = os.path.join(CACHE_DIR, "etags.json")
+COEFFICIENTS_PER_SEMESTER = 6 * 2
+TIDE_KEYS = ("first_tide", "second_tide", "third_tide", "fourth_tide")
+
+_session = requests.Session()
+_session.headers["Connection"] = "keep-alive"
+_session.headers["Accept-Encoding"] = "gzip"
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=Retry(total=3, backoff_factor=0.5))
+_session.mount("http://", _adapter)
+_session.mount("https://", _adapter)
+
+_created_directories = set()
+_get_tide_fields = itemgetter("altura", "hora", "tipo")
+# ETag/Last-Modified headers of the last tide responses, keyed by URL. Only valid
+# while the port details and coefficients embedded in the tide files stay the same
+_validators = {}
+
+def get_session():
+    return _session
 
 def main():
-    ports = fetch_ports()
-    write_ports_file(ports)
     current_year = datetime.datetime.now().year
-    coefficients_map = fetch_coefficients(current_year)
-    write_coefficients_file(coefficients_map)
-    for port in ports:
-        for month in range(1, 12 + 1, 1):
-            handle_port_month(port, month, current_year, coefficients_map)
+    previous_embedded_digest = load_validators()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # The coefficients PDF is downloaded and parsed while the port list is fetched
+        coefficients_future = executor.submit(fetch_coefficients, current_year)
+        ports = fetch_ports(current_year)
+        write_ports_file(ports)
+        coefficients_map = coefficients_future.result()
+        write_coefficients_file(coefficients_map)
+        embedded_digest = embedded_data_digest(ports, coefficients_map)
+        if embedded_digest != previous_embedded_digest:
+            # Tide files embed port details and coefficients, so they must be rewritten even if the tides are unchanged
+            _validators.clear()
+        tasks = []
+        for port in ports:
+            directory = port_tides_directory(current_year, port)
+            ensure_directory(directory)
+            url_prefix = port_tides_url_prefix(current_year, port)
+            tasks.extend((port, month, url_prefix, directory + "/") for month in range(1, 12 + 1, 1))
+        try:
+            # list() forces every task to run and re-raises the first failure
+            list(executor.map(lambda task: handle_port_month(*task, coefficients_map), tasks))
+        except BaseException:
+            # Otherwise leaving the with block would wait for every queued task before reporting the failure
+            executor.shutdown(cancel_futures=True)
+            raise
+    save_validators(embedded_digest)
 
-def fetch_ports():
-    response = requests.get("http://ideihm.covam.es/api-ihm/getmarea?request=getlist&format=json")
-    return response.json()["estaciones"]["puertos"]
+def fetch_ports(current_year):
+    ports = read_cache(current_year, "ports.json")
+    if ports is None:
+        response = get_session().get("http://ideihm.covam.es/api-ihm/getmarea?request=getlist&format=json", timeout=REQUEST_TIMEOUT)
+        ports = loads_json(response.content)["estaciones"]["puertos"]
+        write_cache(ports, current_year, "ports.json")
+    return ports
 
 def write_ports_file(ports):
     ports_json = {
@@ -36,102 +107,179 @@ def write_ports_file(ports):
     write_json(ports_json, "public/ports.json")
 
 def fetch_coefficients(current_year):
-    response = requests.get(f"https://armada.defensa.gob.es/ihm/Documentacion/Mareas/docs/coeficientes_{current_year}.pdf")
-    coefficients_map = {"coefficients": {}}
-    with pdfplumber.open(BytesIO(response.content)) as pdf:
-        first_page = pdf.pages[0]
-        rows = first_page.extract_table(table_settings={"vertical_strategy": "text", "horizontal_strategy": "text", "snap_tolerance": 4})
-        first_semester = False
-        for row in rows:
-            first_semester = handle_coefficients_pdf_row(row, coefficients_map, current_year, first_semester)
+    coefficients_map = read_cache(current_year, "coefficients.json")
+    if coefficients_map is None:
+        coefficients_map = download_coefficients(current_year)
+        write_cache(coefficients_map, current_year, "coefficients.json")
     return coefficients_map
 
-def handle_coefficients_pdf_row(row, coefficients_map, current_year, first_semester):
+def download_coefficients(current_year):
+    response = get_session().get(f"https://armada.defensa.gob.es/ihm/Documentacion/Mareas/docs/coeficientes_{current_year}.pdf", timeout=REQUEST_TIMEOUT)
+    entries = []
+    month_prefixes = [f"{current_year}-{month:02d}-" for month in range(1, 12 + 1, 1)]
+    with fitz.open(stream=response.content, filetype="pdf") as pdf:
+        first_page = pdf[0]
+        table = first_page.find_tables(vertical_strategy="text", horizontal_strategy="text", snap_tolerance=4)[0]
+        first_semester = False
+        for row in table.extract():
+            # PyMuPDF reports empty cells as None, pdfplumber used empty strings
+            row = [cell or "" for cell in row]
+            first_semester = handle_coefficients_pdf_row(row, entries, month_prefixes, first_semester)
+    coefficients = {}
+    for key, value in entries:
+        coefficients.setdefault(key, []).append(value)
+    return {"coefficients": coefficients}
+
+def handle_coefficients_pdf_row(row, entries, month_prefixes, first_semester):
     if row[0].isnumeric():
         day = int(row[0])
         if day == 1:
             first_semester = not first_semester
-        num_traversed_coefficients = 0
-        month = 1 if first_semester else 7
-        for i in range(1, len(row), 1):
-            cell = row[i]
-            coefficients = cell.split()
-            if (len(coefficients) == 0):
-                (num_traversed_coefficients, month) = register_coefficients("0", coefficients_map, current_year, month, day, num_traversed_coefficients)
-            else:
-                if i == len(row) - 2 and len(coefficients) < 2:
-                    if not row[len(row) - 1]:
-                        coefficients.append(0)
-                    elif not row[len(row) - 3]:
-                        coefficients.insert(0, 0)
-                for j in range(len(coefficients)):
-                    (num_traversed_coefficients, month) = register_coefficients(coefficients[j], coefficients_map, current_year, month, day, num_traversed_coefficients)
+        # Each month spans two coefficients, starting at January or July
+        first_month_index = 0 if first_semester else 6
+        day_suffix = f"{day:02d}"
+        # A mis-segmented row can yield extra trailing coefficients, which belong to no month
+        for index, coefficient in enumerate(itertools.islice(row_coefficients(row), COEFFICIENTS_PER_SEMESTER)):
+            key = month_prefixes[first_month_index + index // 2] + day_suffix
+            entries.append((key, float(coefficient) if coefficient else 0))
 
     return first_semester
 
-def register_coefficients(coefficient_string, coefficients_map, current_year, month, day, num_traversed_coefficients):
-    key = f"{current_year}-{month:02d}-{day:02d}"
-    value = float(coefficient_string) if coefficient_string else 0
-    if not key in coefficients_map["coefficients"]:
-        coefficients_map["coefficients"][key] = [value]
-    else:
-        coefficients_map["coefficients"][key].append(value)
-    num_traversed_coefficients += 1
-    if num_traversed_coefficients >= 2:
-        num_traversed_coefficients = 0
-        month += 1
-    return (num_traversed_coefficients, month)
+def row_coefficients(row):
+    for i in range(1, len(row), 1):
+        coefficients = row[i].split()
+        if (len(coefficients) == 0):
+            yield "0"
+        else:
+            if i == len(row) - 2 and len(coefficients) < 2:
+                if not row[len(row) - 1]:
+                    coefficients.append(0)
+                elif not row[len(row) - 3]:
+                    coefficients.insert(0, 0)
+            yield from coefficients
 
 def write_coefficients_file(coefficients_map):
     write_json(coefficients_map, "public/coefficients.json")
 
-def handle_port_month(port, month, year, coefficients_map):
+def handle_port_month(port, month, url_prefix, filename_prefix, coefficients_map):
     tides_json = {
         "port_id": port["id"],
         "port_code": port["code"],
         "port_name": port["puerto"],
         "month": month
     }
-    data = download_port_month_data(port, month, year)
-    build_tides_json_for_port_month(data["mareas"]["datos"]["marea"], tides_json, coefficients_map)
-    write_json(tides_json, f"public/tides/{year}/{port['code']}/{month:02d}.json")
+    month_string = f"{month:02d}"
+    filename = filename_prefix + month_string + ".json"
+    with download_port_month_data(url_prefix + month_string, filename) as values:
+        if values is None:
+            # Not modified since the last run, the existing file is still valid
+            return
+        build_tides_json_for_port_month(values, tides_json, coefficients_map)
+    write_json(tides_json, filename)
+
+def port_tides_directory(year, port):
+    return f"public/tides/{year}/{port['code']}"
 
-def download_port_month_data(port, month, year):
-    response = requests.get(f"http://ideihm.covam.es/api-ihm/getmarea?request=gettide&id={port['id']}&format=json&month={year}{month:02d}")
-    return response.json()
+def port_tides_url_prefix(year, port):
+    return f"http://ideihm.covam.es/api-ihm/getmarea?request=gettide&id={port['id']}&format=json&month={year}"
+
+@contextlib.contextmanager
+def download_port_month_data(url, filename):
+    headers = conditional_headers(url) if os.path.exists(filename) else {}
+    # Streams the tides one by one instead of loading the whole response in memory
+    with get_session().get(url, headers=headers, timeout=REQUEST_TIMEOUT, stream=True) as response:
+        if response.status_code == 304:
+            # Consumes the empty body so the connection goes back to the pool instead of being closed
+            response.content
+            yield None
+            return
+        response.raw.decode_content = True
+        yield ijson.items(response.raw, "mareas.datos.marea.item", use_float=True)
+        remember_validators(url, response)
+
+def conditional_headers(url):
+    validators = _validators.get(url, {})
+    headers = {}
+    if "etag" in validators:
+        headers["If-None-Match"] = validators["etag"]
+    if "last_modified" in validators:
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+def remember_validators(url, response):
+    validators = {}
+    if "ETag" in response.headers:
+        validators["etag"] = response.headers["ETag"]
+    if "Last-Modified" in response.headers:
+        validators["last_modified"] = response.headers["Last-Modified"]
+    if validators:
+        _validators[url] = validators
+    else:
+        _validators.pop(url, None)
 
 def build_tides_json_for_port_month(values, tides_json, coefficients_map):
-    i = 0
-    while i + 2 < len (values):
-        increment = build_tides_json_for_port_day(i, values, tides_json, coefficients_map)
-        i += increment
-
-def build_tides_json_for_port_day(index, values, tides_json, coefficients_map):
-    tides_day = {
-        "first_tide": build_tide_json(values[index], coefficients_map["coefficients"][values[index]["fecha"]]),
-        "second_tide": build_tide_json(values[index + 1], coefficients_map["coefficients"][values[index + 1]["fecha"]]),
-        "third_tide": build_tide_json(values[index + 2], coefficients_map["coefficients"][values[index + 2]["fecha"]])
-    }
-    increment = 3
-    if index + 3 < len(values):
-        if values[index + 3]["fecha"] == values[index]["fecha"]:
-            tides_day["fourth_tide"] = build_tide_json(values[index + 3], coefficients_map["coefficients"][values[index + 3]["fecha"]])
-            increment = 4
-    tides_json[values[index]["fecha"]] = tides_day
-    return increment
+    for date, day_values in itertools.groupby(values, key=itemgetter("fecha")):
+        build_tides_json_for_port_day(date, day_values, tides_json, coefficients_map)
+
+def build_tides_json_for_port_day(date, values, tides_json, coefficients_map):
+    coefficients = coefficients_map["coefficients"][date]
+    tides_json[date] = {key: build_tide_json(value, coefficients) for key, value in zip(TIDE_KEYS, values)}
 
 def build_tide_json(values, coefficients):
+    meters, tide_time, tide_type = _get_tide_fields(values)
     return {
-        "meters": values["altura"],
-        "time": values["hora"],
-        "coefficient": coefficients[0] if int(values["hora"].split(":")[0]) < 12 else coefficients[1],
-        "high_tide": values["tipo"] == 'pleamar'
+        "meters": meters,
+        "time": tide_time,
+        "coefficient": coefficients[0] if tide_time < "12" else coefficients[1],
+        "high_tide": tide_type == 'pleamar'
     }
 
 def write_json(tides_json, filename):
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-    with open(filename, "w") as f:
-        json.dump(tides_json, f, separators=(',', ':'))
+    ensure_directory(os.path.dirname(filename))
+    data = memoryview(dumps_json(tides_json))
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+
+def ensure_directory(directory):
+    if directory not in _created_directories:
+        os.makedirs(directory, exist_ok=True)
+        _created_directories.add(directory)
+
+def read_cache(year, name):
+    filename = os.path.join(CACHE_DIR, str(year), name)
+    try:
+        if time.time() - os.path.getmtime(filename) >= CACHE_MAX_AGE_SECONDS:
+            return None
+        with open(filename, "rb") as f:
+            return loads_json(f.read())
+    except (OSError, ValueError):
+        return None
+
+def load_validators():
+    try:
+        with open(VALIDATORS_FILE, "rb") as f:
+            data = loads_json(f.read())
+    except (OSError, ValueError):
+        return None
+    _validators.update(data.get("validators", {}))
+    return data.get("embedded_digest")
+
+def save_validators(embedded_digest):
+    write_json({"embedded_digest": embedded_digest, "validators": _validators}, VALIDATORS_FILE)
+
+def embedded_data_digest(ports, coefficients_map):
+    embedded_data = {
+        "ports": [[port["id"], port["code"], port["puerto"]] for port in ports],
+        "coefficients": coefficients_map
+    }
+    return hashlib.sha256(dumps_json(embedded_data)).hexdigest()
+
+def write_cache(obj, year, name):
+    write_json(obj, os.path.join(CACHE_DIR, str(year), name))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file